@@ -1,10 +1,37 @@
 # app.py
 
+import csv
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from streamlit.runtime.uploaded_file_manager import UploadedFile
+import numpy as np
 import pandas as pd
 from pathlib import Path
 from io import BytesIO
 
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    STRING_DTYPE = "string[pyarrow]"  # operações .str rodam nos kernels do Arrow
+except ImportError:
+    pa = None
+    STRING_DTYPE = "string"
+
+# Nº de linhas lidas por vez do CSV (limita o pico de memória)
+CSV_CHUNKSIZE = 500_000
+
+# Tabela para converter "1.234,56" em "1234.56" com um único str.translate
+TABELA_VALOR_BR = str.maketrans({".": "", ",": "."})
+# Qualquer caractere que não seja dígito, ponto ou hífen. Fica como texto, e não
+# re.compile: com strings Arrow, um padrão compilado força o caminho lento em Python
+RE_NAO_NUMERICO = r"[^\d\.-]"
+
+# Colunas do resumo por sheet (formato das tuplas de processar_dataframe)
+COLUNAS_RESULTADO = ["arquivo", "sheet", "total_entrada", "total_saida"]
+
 # ========== CONFIGURAÇÃO DA PÁGINA ==========
 st.set_page_config(
     page_title="Soma de Entradas e Saídas (CFOP)",
@@ -28,107 +55,234 @@ st.write(
 )
 
 # ========== FUNÇÃO PARA PROCESSAR CADA ARQUIVO ==========
-def processar_arquivo(file_buffer: BytesIO, filename: str) -> pd.DataFrame:
+def processar_arquivo(file_buffer: BytesIO, filename: str) -> list:
     """
-    Lê o arquivo (Excel ou CSV) e devolve um DataFrame com a soma de
-    valores de entrada e saída para cada planilha/sheet desse arquivo.
+    Lê o arquivo (Excel ou CSV) e devolve a soma de valores de entrada
+    e saída para cada planilha/sheet desse arquivo.
     
-    Retorna um DataFrame com colunas:
-    ['arquivo', 'sheet', 'total_entrada', 'total_saida']
+    Retorna uma lista de tuplas no formato de COLUNAS_RESULTADO:
+    (arquivo, sheet, total_entrada, total_saida)
     """
     resultados = []
     ext = Path(filename).suffix.lower()
 
     # --- PARA EXCEL: ler todas as sheets ---
     if ext in [".xlsx", ".xls"]:
-        sheets_dict = pd.read_excel(
-            file_buffer,
-            sheet_name=None,
-            skiprows=17,            # pular até a linha 17 (linha 18 vira cabeçalho)
-            dtype={"CFOP": str},    # força CFOP como texto
-            engine="openpyxl"
-        )
-        for sheet_name, df in sheets_dict.items():
-            resultado = processar_dataframe(df, filename, sheet_name)
-            resultados.append(resultado)
-
-    # --- PARA CSV: lê apenas como um único DataFrame ---
+        # calamine (Rust) é bem mais rápido que openpyxl; .xls segue pelo xlrd
+        engine = "calamine" if ext == ".xlsx" else "xlrd"
+        # Abre o workbook uma única vez e lê cada sheet a partir dele;
+        # o `with` libera o workbook mesmo se alguma sheet falhar
+        with pd.ExcelFile(file_buffer, engine=engine) as xl:
+            for sheet_name in xl.sheet_names:
+                df = xl.parse(
+                    sheet_name,
+                    skiprows=17,            # pular até a linha 17 (linha 18 vira cabeçalho)
+                    dtype={"CFOP": str}     # força CFOP como texto
+                )
+                resultado = processar_dataframe(df, filename, sheet_name)
+                resultados.append(resultado)
+
+    # --- PARA CSV: uma única tabela, lida em blocos ---
     elif ext == ".csv":
-        df = pd.read_csv(
-            file_buffer,
-            skiprows=17,
-            dtype={"CFOP": str},   # força CFOP como texto
-            sep=None,              # autodetectar delimitador
-            engine="python"
-        )
-        resultado = processar_dataframe(df, filename, "CSV")
-        resultados.append(resultado)
+        total_entrada, total_saida = somar_csv(file_buffer, filename)
+        resultados.append((filename, "CSV", total_entrada, total_saida))
 
     else:
         st.error(f"⚠️ Formato não suportado: {ext}")
-        return pd.DataFrame()
 
-    # Concatena resultados de todas as sheets lidas do arquivo
-    if resultados:
-        return pd.concat(resultados, ignore_index=True)
-    else:
-        return pd.DataFrame()
+    return resultados
 
 
-def processar_dataframe(df: pd.DataFrame, arquivo: str, sheet: str) -> pd.DataFrame:
+@st.cache_data(show_spinner=False)
+def processar_arquivo_em_cache(uploaded_file: UploadedFile) -> list:
     """
-    Recebe o DataFrame lido (já a partir da linha 18) e devolve
-    um DataFrame com soma de entradas e saídas para aquela sheet.
+    Versão memorizada de `processar_arquivo`, indexada pelo conteúdo e pelo
+    nome do arquivo: reexecuções do script não voltam a ler a mesma planilha.
+
+    Exige um UploadedFile: o Streamlit o indexa por nome, posição e conteúdo
+    (um BytesIO comum não tem `.name`). Como já é um BytesIO, é lido
+    diretamente, sem copiar os bytes para um novo buffer.
     """
-    # Renomear colunas para remover espaços acidentais
-    df = df.rename(columns=lambda x: str(x).strip())
+    return processar_arquivo(uploaded_file, uploaded_file.name)
 
-    # Verifica se as colunas mínimas estão presentes
-    colunas_necessarias = {"CFOP", "Valor NF"}
-    faltantes = colunas_necessarias - set(df.columns)
-    if faltantes:
-        st.warning(f"No arquivo **{arquivo}**, sheet **{sheet}** faltam colunas: {faltantes}")
-        return pd.DataFrame({
-            "arquivo": [arquivo],
-            "sheet": [sheet],
-            "total_entrada": [0.0],
-            "total_saida": [0.0]
-        })
 
-    # Garante que CFOP seja string e retira espaços
-    df["CFOP"] = df["CFOP"].astype(str).str.strip()
+def posicionar_csv(file_buffer: BytesIO) -> str:
+    """
+    Posiciona o buffer no início da linha 18 (cabeçalho da tabela) e detecta
+    o delimitador a partir de uma amostra das linhas seguintes.
+
+    As 17 linhas iniciais são puladas aqui, e não via `skiprows`, para que a
+    leitura já comece no cabeçalho e a amostra contenha só linhas da tabela.
+    """
+    amostra = file_buffer.read(65536)
+    inicio = 0
+    for _ in range(17):
+        fim = amostra.find(b"\n", inicio)
+        if fim == -1:
+            inicio = len(amostra)
+            break
+        inicio = fim + 1
+    file_buffer.seek(inicio)
+
+    texto = amostra[inicio:].decode("utf-8", errors="replace")
+    try:
+        dialect = csv.Sniffer().sniff(texto, delimiters=",;\t|")
+        return dialect.delimiter
+    except csv.Error:
+        return ","
+
+
+def limpar_valor_br(valores: pd.Series) -> pd.Series:
+    """
+    Converte valores no estilo brasileiro ("R$ 1.234,56") para float,
+    com 0.0 onde não houver número.
+    """
+    valores = (
+        valores.astype(STRING_DTYPE)
+        .str.translate(TABELA_VALOR_BR)          # remove pontos (milhares) e troca vírgula → ponto, numa só passada
+        .str.replace(RE_NAO_NUMERICO, "", regex=True)  # remove qualquer outro caractere que não seja dígito, ponto ou hífen
+    )
+    return pd.to_numeric(valores, errors="coerce").fillna(0.0)
+
+
+def somar_csv(file_buffer: BytesIO, filename: str) -> tuple:
+    """
+    Lê o CSV em blocos de CSV_CHUNKSIZE linhas, para não carregar arquivos
+    muito grandes inteiros na memória, e devolve (total_entrada, total_saida).
+
+    O formato de "Valor NF" é decidido para o arquivo inteiro, como numa
+    leitura única: a conversão direta só vale se todos os blocos a aceitarem.
+    Se um bloco exigir a limpeza BR depois de outros já somados, o arquivo é
+    relido desde o início no formato BR.
+    """
+    sep = posicionar_csv(file_buffer)   # já pula as 17 linhas iniciais
+    inicio = file_buffer.tell()
+    formato_br = False
+    while True:
+        file_buffer.seek(inicio)
+        total_entrada = total_saida = 0.0
+        blocos_somados = 0
+        with pd.read_csv(
+            file_buffer,
+            dtype=str,             # tudo como texto (os nomes das colunas podem vir com espaços)
+            sep=sep,
+            engine="c",            # o engine pyarrow não suporta chunksize
+            chunksize=CSV_CHUNKSIZE
+        ) as leitor:
+            for chunk in leitor:
+                colunas = [str(x).strip() for x in chunk.columns]
+                if not verificar_colunas(colunas, filename, "CSV"):
+                    return 0.0, 0.0
+                chunk.columns = colunas
+
+                valores = None
+                if not formato_br:
+                    valores = converter_direto(chunk["Valor NF"])
+                    if valores is None:
+                        formato_br = True
+                        if blocos_somados:
+                            break   # blocos anteriores foram somados no formato errado
+                if formato_br:
+                    valores = limpar_valor_br(chunk["Valor NF"])
+
+                entrada, saida = somar_entradas_saidas(chunk["CFOP"], valores)
+                total_entrada += entrada
+                total_saida += saida
+                blocos_somados += 1
+            else:
+                return total_entrada, total_saida
+
+
+def processar_dataframe(df: pd.DataFrame, arquivo: str, sheet: str) -> tuple:
+    """
+    Recebe o DataFrame lido (já a partir da linha 18) e devolve a tupla
+    (arquivo, sheet, total_entrada, total_saida) para aquela sheet.
+    """
+    # Sheets vazias (ex.: abas "Capa" sem tabela) não têm o que somar
+    if df.empty:
+        return (arquivo, sheet, 0.0, 0.0)
+
+    # Nomes de colunas sem espaços acidentais; verifica as colunas mínimas
+    # antes de qualquer transformação dos dados
+    colunas = [str(x).strip() for x in df.columns]
+    if not verificar_colunas(colunas, arquivo, sheet):
+        return (arquivo, sheet, 0.0, 0.0)
+    df.columns = colunas   # renomeia sem copiar os dados
 
     # ————— TRATAMENTO CORRETO DE "Valor NF" —————
     if pd.api.types.is_numeric_dtype(df["Valor NF"]):
         # Já é numérico, basta preencher NaN
-        df["Valor NF"] = df["Valor NF"].fillna(0.0)
+        valores = df["Valor NF"].fillna(0.0)
     else:
-        # Se veio como string (ex.: "1.234,56"), remover pontos de milhar, trocar vírgula por ponto
-        df["Valor NF"] = (
-            df["Valor NF"].astype(str)
-            .str.replace(r"\.", "", regex=True)     # remove pontos (milhares)
-            .str.replace(",", ".", regex=False)     # vírgula → ponto decimal
-            .str.replace(r"[^\d\.-]", "", regex=True)  # remove qualquer outro caractere que não seja dígito, ponto ou hífen
-        )
-        df["Valor NF"] = pd.to_numeric(df["Valor NF"], errors="coerce").fillna(0.0)
+        # Muitas planilhas já exportam o valor normalizado (ex.: "1234.56");
+        # se não, veio como string (ex.: "1.234,56"): remover pontos de milhar, trocar vírgula por ponto
+        valores = converter_direto(df["Valor NF"])
+        if valores is None:
+            valores = limpar_valor_br(df["Valor NF"])
     # ——— FIM DO TRATAMENTO ———
 
-    # Máscaras para entrada (CFOP 1xx, 2xx, 3xx) e saída (CFOP 5xx, 6xx, 7xx)
-    mask_entrada = df["CFOP"].str.startswith(("1", "2", "3"))
-    mask_saida   = df["CFOP"].str.startswith(("5", "6", "7"))
+    total_entrada, total_saida = somar_entradas_saidas(df["CFOP"], valores)
+    return (arquivo, sheet, total_entrada, total_saida)
 
-    total_entrada = df.loc[mask_entrada, "Valor NF"].sum()
-    total_saida   = df.loc[mask_saida,   "Valor NF"].sum()
 
-    return pd.DataFrame({
-        "arquivo": [arquivo],
-        "sheet":   [sheet],
-        "total_entrada": [total_entrada],
-        "total_saida":   [total_saida]
-    })
+def verificar_colunas(colunas: list, arquivo: str, sheet: str) -> bool:
+    """
+    Verifica se as colunas mínimas estão presentes (com nomes já sem espaços);
+    caso contrário, exibe um aviso e devolve False.
+    """
+    colunas_necessarias = {"CFOP", "Valor NF"}
+    faltantes = colunas_necessarias - set(colunas)
+    if faltantes:
+        st.warning(f"No arquivo **{arquivo}**, sheet **{sheet}** faltam colunas: {faltantes}")
+        return False
+    return True
+
+
+def converter_direto(valores: pd.Series):
+    """
+    Converte "Valor NF" em texto direto para número, com 0.0 nas células vazias.
+    Devolve None se alguma célula preenchida não converter (formato BR).
+    """
+    texto = valores.astype(STRING_DTYPE)
+    direto = pd.to_numeric(texto, errors="coerce")
+    if direto.notna().sum() != texto.notna().sum():
+        return None
+    return direto.fillna(0.0)
+
+
+def somar_entradas_saidas(cfop: pd.Series, valores: pd.Series) -> tuple:
+    """
+    Recebe as colunas CFOP e Valor NF (já numérica) e devolve
+    (total_entrada, total_saida).
+    """
+    # Garante que CFOP seja string e retira espaços
+    cfop = cfop.astype(STRING_DTYPE).str.strip()
+
+    # Categoria de cada registro pelo primeiro dígito do CFOP (-1 quando não é
+    # dígito): 0 = entrada (1xx, 2xx, 3xx), 1 = saída (5xx, 6xx, 7xx), -1 = ignorado.
+    # int8 basta para um dígito e reduz os bytes percorridos nas comparações
+    digito = pd.to_numeric(cfop.str[0], errors="coerce").to_numpy(
+        dtype=np.int8, na_value=-1
+    )
+    categoria = np.full(digito.shape, -1, dtype=np.int8)
+    categoria[(digito >= 1) & (digito <= 3)] = 0
+    categoria[(digito >= 5) & (digito <= 7)] = 1
+
+    # Soma as duas categorias numa única passada sobre "Valor NF"
+    # (mantido em float64: em float32 valores acima de ~R$ 100 mil perdem os centavos)
+    valores = valores.to_numpy(dtype=float, na_value=0.0)
+    validos = categoria >= 0
+    total_entrada, total_saida = np.bincount(
+        categoria[validos], weights=valores[validos], minlength=2
+    )
+
+    return float(total_entrada), float(total_saida)
 
 
 # ========== UI: UPLOADER DE ARQUIVOS ==========
+# Valores em reais formatados no navegador (sem gerar HTML célula a célula no servidor)
+COLUNA_REAIS = st.column_config.NumberColumn(format="R$ %.2f")
+
 st.sidebar.header("📂 Upload de Arquivos")
 arquivos = st.sidebar.file_uploader(
     "Selecione uma ou mais planilhas (Excel ou CSV)",
@@ -142,60 +296,65 @@ if not arquivos:
 
 # Botão para processar
 if st.sidebar.button("▶️ Processar arquivos"):
-    todos_resultados = []
     barra = st.progress(0)
 
-    for idx, uploaded_file in enumerate(arquivos):
-        # Lê em BytesIO para permitir múltiplas leituras (Excel precisa disso)
-        file_bytes = uploaded_file.read()
-        file_buffer = BytesIO(file_bytes)
-        filename = uploaded_file.name
-
-        df_res = processar_arquivo(file_buffer, filename)
-        if not df_res.empty:
-            todos_resultados.append(df_res)
+    # Cada arquivo é processado em uma thread; o contexto do Streamlit é
+    # anexado às threads para que avisos (st.warning/st.error) apareçam na página
+    ctx = get_script_run_ctx()
+    resultados_por_idx = {}
+    with ThreadPoolExecutor(
+        max_workers=min(len(arquivos), os.cpu_count() or 1),
+        initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)
+    ) as executor:
+        futuros = {}
+        for idx, uploaded_file in enumerate(arquivos):
+            # Volta ao início: a posição do buffer também entra na chave do cache
+            uploaded_file.seek(0)
+            futuro = executor.submit(processar_arquivo_em_cache, uploaded_file)
+            futuros[futuro] = idx
 
-        barra.progress((idx + 1) / len(arquivos))
+        for concluidos, futuro in enumerate(as_completed(futuros), start=1):
+            resultados_por_idx[futuros[futuro]] = futuro.result()
+            barra.progress(concluidos / len(arquivos))
 
-    # Concatena resultados de todos os arquivos
-    if todos_resultados:
-        df_final = pd.concat(todos_resultados, ignore_index=True)
-    else:
-        df_final = pd.DataFrame(
-            columns=["arquivo", "sheet", "total_entrada", "total_saida"]
-        )
+    # Junta as linhas de todos os arquivos (na ordem original dos uploads)
+    # e monta um único DataFrame no final
+    linhas = []
+    for idx in range(len(arquivos)):
+        linhas.extend(resultados_por_idx[idx])
+    df_final = pd.DataFrame(linhas, columns=COLUNAS_RESULTADO)
 
     # ===================================================
     # 1) Exibição: resumo detalhado por arquivo e sheet
     # ===================================================
     st.markdown("## 📑 Resumo Detalhado por Arquivo e Sheet")
-    st.dataframe(df_final.style.format({
-        "total_entrada": "R$ {:,.2f}",
-        "total_saida":   "R$ {:,.2f}"
-    }), height=350)
+    st.dataframe(df_final, height=350, column_config={
+        "total_entrada": COLUNA_REAIS,
+        "total_saida":   COLUNA_REAIS
+    })
 
     # ===================================================
     # 2) Exibição: resumo agregado por NOME DE ARQUIVO
     # ===================================================
     if not df_final.empty:
-        df_por_arquivo = (
-            df_final
-            .groupby("arquivo", as_index=False)
-            .agg({
-                "total_entrada": "sum",
-                "total_saida":   "sum"
-            })
-            .rename(columns={
-                "total_entrada": "soma_entrada_no_arquivo",
-                "total_saida":   "soma_saida_no_arquivo"
-            })
-        )
+        # Soma por arquivo via factorize + bincount (sem a maquinaria do groupby);
+        # sort=True mantém os arquivos em ordem alfabética, como no groupby
+        codigos, nomes = pd.factorize(df_final["arquivo"], sort=True)
+        df_por_arquivo = pd.DataFrame({
+            "arquivo": nomes,
+            "soma_entrada_no_arquivo": np.bincount(
+                codigos, weights=df_final["total_entrada"].to_numpy()
+            ),
+            "soma_saida_no_arquivo": np.bincount(
+                codigos, weights=df_final["total_saida"].to_numpy()
+            )
+        })
 
         st.markdown("## 📂 Resumo Agregado por Nome de Arquivo")
-        st.dataframe(df_por_arquivo.style.format({
-            "soma_entrada_no_arquivo": "R$ {:,.2f}",
-            "soma_saida_no_arquivo":   "R$ {:,.2f}"
-        }), height=250)
+        st.dataframe(df_por_arquivo, height=250, column_config={
+            "soma_entrada_no_arquivo": COLUNA_REAIS,
+            "soma_saida_no_arquivo":   COLUNA_REAIS
+        })
     else:
         st.info("Nenhum resultado para agrupar por arquivo.")
 
@@ -213,7 +372,13 @@ if st.sidebar.button("▶️ Processar arquivos"):
     # ===================================================
     # 4) Download CSV com todos os resultados (sheet-level)
     # ===================================================
-    csv_export = df_final.to_csv(index=False).encode("utf-8")
+    if pa is not None:
+        # Writer CSV do Arrow (C++) já gera os bytes em UTF-8
+        buffer_csv = BytesIO()
+        pa_csv.write_csv(pa.Table.from_pandas(df_final, preserve_index=False), buffer_csv)
+        csv_export = buffer_csv.getvalue()
+    else:
+        csv_export = df_final.to_csv(index=False).encode("utf-8")
     st.download_button(
         label="⬇️ Baixar resultados consolidados (.csv)",
         data=csv_export,